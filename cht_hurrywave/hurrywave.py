@@ -11,6 +11,7 @@ import numpy as np
 import xarray as xr
 
 import math
+from numba import njit, prange
 from pyproj import CRS
 from pyproj import Transformer
 
@@ -56,7 +57,7 @@ class HurryWave:
     - outline:
          Returns the outline of the model domain.
     - make_index_tiles:
-         Generates and writes index tiles for the model grid at specified zoom levels.
+         Generates and writes index tiles (256x256 little-endian int32) for the model grid at specified zoom levels.
     """
     
     def __init__(self, load=False, crs=None, path=None, exe_path=None, read_grid_data=True):
@@ -80,6 +81,9 @@ class HurryWave:
         else:
             self.exe_path = exe_path
 
+        # Cache for grid_coordinates, keyed by grid geometry and location
+        self._grid_coords_cache = {}
+
         # Initialize input variables
         self.input                      = HurryWaveInput(self)
 
@@ -171,13 +175,9 @@ class HurryWave:
 
         file_name = os.path.join(path, file_name)
                     
-        # Open netcdf file
-        ddd = xr.open_dataset(file_name)
-        stations=ddd.station_name.values
-        all_stations = []
-        for ist, st in enumerate(stations):
-            st=str(st.strip())[2:-1]
-            all_stations.append(st)
+        # Open netcdf file (lazily with dask, so only the selected stations are read)
+        ddd = xr.open_dataset(file_name, chunks={"stations": 256})
+        all_stations = np.char.decode(np.char.strip(ddd.station_name.values.astype("S")), "utf-8").tolist()
         
         times   = ddd.point_hm0.coords["time"].values
 
@@ -187,17 +187,23 @@ class HurryWave:
             for st in all_stations:
                 name_list.append(st)
         
-        df = pd.DataFrame(index=times, columns=name_list)
-        
         data_tmp = ddd["point_" + parameter]
 
-        for station in name_list:
-            for ist, st in enumerate(all_stations):
-                if station == st:
-                    data = data_tmp.isel(stations=ist).values
-                    data[np.isnan(data)] = -999.0
-                    df[st]=data
-                    break            
+        # Look up station indices (first match) and read all stations at once
+        station_index = {}
+        for ist, st in enumerate(all_stations):
+            station_index.setdefault(st, ist)
+        icol = [ic for ic, st in enumerate(name_list) if st in station_index]
+
+        # Fill one 2D array and build the dataframe from it in one go
+        # (stations that are not found remain NaN)
+        data = np.full((len(times), len(name_list)), np.nan, dtype=data_tmp.dtype)
+        if icol:
+            values = data_tmp.isel(stations=[station_index[name_list[ic]] for ic in icol]).values
+            values[np.isnan(values)] = -999.0
+            data[:, icol] = values
+
+        df = pd.DataFrame(data, index=times, columns=name_list)
 
         ddd.close()
         
@@ -230,24 +236,26 @@ class HurryWave:
         if not map_file:
             map_file = os.path.join(self.path, "hurrywave_map.nc")
             
-        dsin = xr.open_dataset(map_file)
+        # Open with dask, so that the maximum is computed one time chunk at a time
+        dsin = xr.open_dataset(map_file, chunks={"timemax": "auto", "time": "auto"})
 
         output_times = dsin.timemax.values
         if time_range is None:
+            time_range = [output_times[0], output_times[-1]]
 
-            t0 = pd.to_datetime(str(output_times[0])).replace(tzinfo=None).to_pydatetime()
-            t1 = pd.to_datetime(str(output_times[-1])).replace(tzinfo=None).to_pydatetime()
-            time_range = [t0, t1]
-
-        it0 = -1
-        for it, time in enumerate(output_times):
-            time = pd.to_datetime(str(time)).replace(tzinfo=None).to_pydatetime()
-            if time>=time_range[0] and it0<0:
-                it0 = it
-            if time<=time_range[1]:
-                it1 = it
+        # First output time >= t0 and last output time <= t1
+        t0  = np.datetime64(pd.Timestamp(time_range[0]))
+        t1  = np.datetime64(pd.Timestamp(time_range[1]))
+        it0 = np.searchsorted(output_times, t0, side="left")
+        it1 = np.searchsorted(output_times, t1, side="right") - 1
         
-        zs_da = np.amax(dsin[parameter].values[it0:it1,:,:], axis=0)
+        if it1 <= it0:
+            dsin.close()
+            raise ValueError(f"No output times in time range {time_range[0]} - {time_range[1]}")
+
+        da    = dsin[parameter]
+        tdim  = da.dims[0]
+        zs_da = da.isel({tdim: slice(it0, it1)}).max(dim=tdim, skipna=False).values
         dsin.close()
         
         return zs_da
@@ -268,17 +276,22 @@ class HurryWave:
             t00     = datetime.timedelta(seconds=self.input.variables.t0out + self.input.variables.dtmaxout)
             output_times = pd.date_range(start=self.input.variables.tstart + t00,
                                           end=self.input.variables.tstop,
-                                          freq=freqstr).to_pydatetime().tolist()
+                                          freq=freqstr).values
             nt = len(output_times)
             
             if time_range is None:
                 time_range = [self.input.variables.tstart + t00, self.input.variables.tstop]
-            
-            for it, time in enumerate(output_times):
-                if time<=time_range[0]:
-                    it0 = it
-                if time<=time_range[1]:
-                    it1 = it
+
+            # Last output times <= t0 and t1
+            t0  = np.datetime64(pd.Timestamp(time_range[0]))
+            t1  = np.datetime64(pd.Timestamp(time_range[1]))
+            it0 = np.searchsorted(output_times, t0, side="right") - 1
+            it1 = np.searchsorted(output_times, t1, side="right") - 1
+
+            # Start at first output time if t0 is before it
+            it0 = max(it0, 0)
+            if it1 < it0:
+                raise ValueError(f"No output times in time range {time_range[0]} - {time_range[1]}")
     
             # Get maximum values
             nmax = self.input.variables.nmax + 2
@@ -289,11 +302,13 @@ class HurryWave:
             npoints = data_ind[0]
             data_ind = np.squeeze(data_ind[1:])
             
-            # Read zsmax file
-            data_zs = np.fromfile(hm0max_file, dtype="f4")
-            data_zs = np.reshape(data_zs,[nt, npoints + 2])[it0:it1+1, 1:-1]
-
-            data_zs = np.amax(data_zs, axis=0)
+            # Read hm0max file (memory-mapped, so only the requested time steps are read)
+            nbytes = nt * (npoints + 2) * 4
+            if os.path.getsize(hm0max_file) != nbytes:
+                raise ValueError(f"Size of {hm0max_file} ({os.path.getsize(hm0max_file)} bytes) does not match "
+                                 f"{nt} time steps of {npoints} points ({nbytes} bytes)")
+            data_zs = np.memmap(hm0max_file, dtype="<f4", mode="r", shape=(nt, npoints + 2))
+            data_zs = np.amax(data_zs[it0:it1+1, 1:-1], axis=0)
             zs_da = np.full([nmax*mmax], np.nan)        
             zs_da[data_ind - 1] = np.squeeze(data_zs)
             zs_da = np.where(zs_da == -999, np.nan, zs_da)
@@ -301,24 +316,26 @@ class HurryWave:
         
         elif ext==".nc":
 
-            dsin = xr.open_dataset(hm0max_file)
+            # Open with dask, so that the maximum is computed one time chunk at a time
+            dsin = xr.open_dataset(hm0max_file, chunks={"timemax": "auto", "time": "auto"})
 
             output_times = dsin.timemax.values
             if time_range is None:
+                time_range = [output_times[0], output_times[-1]]
 
-                t0 = pd.to_datetime(str(output_times[0])).replace(tzinfo=None).to_pydatetime()
-                t1 = pd.to_datetime(str(output_times[-1])).replace(tzinfo=None).to_pydatetime()
-                time_range = [t0, t1]
-
-            it0 = -1
-            for it, time in enumerate(output_times):
-                time = pd.to_datetime(str(time)).replace(tzinfo=None).to_pydatetime()
-                if time>=time_range[0] and it0<0:
-                    it0 = it
-                if time<=time_range[1]:
-                    it1 = it            
+            # First output time >= t0 and last output time <= t1
+            t0  = np.datetime64(pd.Timestamp(time_range[0]))
+            t1  = np.datetime64(pd.Timestamp(time_range[1]))
+            it0 = np.searchsorted(output_times, t0, side="left")
+            it1 = np.searchsorted(output_times, t1, side="right") - 1
             
-            zs_da = np.amax(dsin[parameter].values[it0:it1,:,:], axis=0)
+            if it1 <= it0:
+                dsin.close()
+                raise ValueError(f"No output times in time range {time_range[0]} - {time_range[1]}")
+
+            da    = dsin[parameter]
+            tdim  = da.dims[0]
+            zs_da = da.isel({tdim: slice(it0, it1)}).max(dim=tdim, skipna=False).values
             dsin.close()
             
         else:
@@ -377,6 +394,18 @@ class HurryWave:
 
     def grid_coordinates(self, loc='cor'):
 
+        # Return cached coordinates if the grid geometry has not changed
+        key = (self.input.variables.x0,
+               self.input.variables.y0,
+               self.input.variables.dx,
+               self.input.variables.dy,
+               self.input.variables.nmax,
+               self.input.variables.mmax,
+               self.input.variables.rotation,
+               loc)
+        if key in self._grid_coords_cache:
+            return self._grid_coords_cache[key]
+
         cosrot = math.cos(self.input.variables.rotation*math.pi/180)
         sinrot = math.sin(self.input.variables.rotation*math.pi/180)
         if loc=="cor":
@@ -394,9 +423,17 @@ class HurryWave:
                                  self.input.variables.nmax*self.input.variables.dy - 0.5*self.input.variables.dy,
                                  num=self.input.variables.nmax)
             
-        xg0, yg0 = np.meshgrid(xx, yy)
-        xg = self.input.variables.x0 + xg0*cosrot - yg0*sinrot
-        yg = self.input.variables.y0 + xg0*sinrot + yg0*cosrot
+        # Broadcast 1D coordinates instead of building a meshgrid
+        xg = self.input.variables.x0 + cosrot*xx[None, :] - sinrot*yy[:, None]
+        yg = self.input.variables.y0 + sinrot*xx[None, :] + cosrot*yy[:, None]
+
+        # Cached arrays are shared between callers, so make them read-only
+        xg.setflags(write=False)
+        yg.setflags(write=False)
+
+        # Drop coordinates of previous grid geometries
+        self._grid_coords_cache = {k: v for k, v in self._grid_coords_cache.items() if k[:-1] == key[:-1]}
+        self._grid_coords_cache[key] = (xg, yg)
 
         return xg, yg
     
@@ -435,7 +472,6 @@ class HurryWave:
                          dem_names=None):
         
         from cht_tiling.tiling import deg2num
-        from cht_tiling.tiling import num2deg
         import cht_utils.fileops as fo
         
         if not zoom_range:
@@ -445,10 +481,27 @@ class HurryWave:
         
         # Compute lon/lat range
         lon_range, lat_range = self.bounding_box(crs=CRS.from_epsg(4326))
+
+        # Compute Global Mercator range, used to skip tiles outside the model
+        xmerc_range, ymerc_range = self.bounding_box(crs=CRS.from_epsg(3857))
         
         cosrot = math.cos(-self.input.variables.rotation*math.pi/180)
-        sinrot = math.sin(-self.input.variables.rotation*math.pi/180)       
-        
+        sinrot = math.sin(-self.input.variables.rotation*math.pi/180)
+
+        x0    = self.input.variables.x0
+        y0    = self.input.variables.y0
+        dx    = self.input.variables.dx
+        dy    = self.input.variables.dy
+        nmax  = self.input.variables.nmax
+        mmax  = self.input.variables.mmax
+
+        # Maximum number of tiles that are projected in one go
+        nbatch = 32
+
+        # Get mask once, raveled in column-major order so that it can be indexed
+        # with the grid indices (m*nmax + n) directly
+        mask = np.asarray(self.grid.ds["mask"].values).ravel(order="F")
+
         transformer_a = Transformer.from_crs(CRS.from_epsg(4326),
                                              CRS.from_epsg(3857),
                                              always_xy=True)
@@ -456,6 +509,10 @@ class HurryWave:
                                              self.crs,
                                              always_xy=True)
 
+        # For models in WGS 84 or Global Mercator, x only depends on the column
+        # and y only on the row of a tile grid
+        separable = self.crs.equals(CRS.from_epsg(4326)) or self.crs.equals(CRS.from_epsg(3857))
+
         # Remove existing path
         if os.path.exists(path):
             print("Removing existing path " + path)
@@ -489,74 +546,94 @@ class HurryWave:
         
             ix0, iy0 = deg2num(lat_range[0], lon_range[0], izoom)
             ix1, iy1 = deg2num(lat_range[1], lon_range[1], izoom)
-        
-            for i in range(ix0, ix1 + 1):
+
+            # Compute lon of tile columns and lat of tile rows at lower-left
+            # corner of the tiles (vectorized num2deg)
+            itile = np.arange(ix0, ix1 + 1)
+            jtile = np.arange(iy0, iy1 + 1)
+            n     = 2 ** izoom
+            lon   = itile / n * 360.0 - 180.0
+            lat   = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * jtile / n))))
+
+            # Convert to Global Mercator (x only depends on lon, y only on lat)
+            xo, _ = transformer_a.transform(lon, np.zeros_like(lon))
+            _, yo = transformer_a.transform(np.zeros_like(lat), lat)
+
+            # Only process tile columns and rows of which the tile grid overlaps
+            # with the model bounding box (padded by one pixel)
+            iok = ((xo + 0.5*dxy <= xmerc_range[1] + dxy) &
+                   (xo + (npix - 0.5)*dxy >= xmerc_range[0] - dxy))
+            jok = ((yo + 0.5*dxy <= ymerc_range[1] + dxy) &
+                   (yo + (npix - 0.5)*dxy >= ymerc_range[0] - dxy))
+            jtiles = jtile[jok]
+        
+            for i in itile[iok]:
             
                 path_okay = False
                 zoom_path_i = os.path.join(zoom_path, str(i))
-            
-                for j in range(iy0, iy1 + 1):
-            
-                    file_name = os.path.join(zoom_path_i, str(j) + ".dat")
-            
-                    # Compute lat/lon at lower-left corner of tile
-                    lat, lon = num2deg(i, j, izoom)
-            
-                    # Convert to Global Mercator
-                    xo, yo   = transformer_a.transform(lon,lat)
-            
-                    # Tile grid on Global Mercator
-                    xm = xv[:] + xo + 0.5*dxy
-                    ym = yv[:] + yo + 0.5*dxy
-                                
-                    # Convert tile grid to crs of HurryWave model
-                    x,y      = transformer_b.transform(xm, ym)
-                    
-                    # Now rotate around origin of HurryWave model
-                    x00 = x - self.input.variables.x0
-                    y00 = y - self.input.variables.y0
-                    xg  = x00*cosrot - y00*sinrot
-                    yg  = x00*sinrot + y00*cosrot
-                    
-                    iind = np.floor(xg/self.input.variables.dx).astype(int)
-                    jind = np.floor(yg/self.input.variables.dy).astype(int)
-                    ind  = iind*self.input.variables.nmax + jind
-                                        
-                    ind[iind<0]   = -999
-                    ind[jind<0]   = -999
-                    ind[iind>=self.input.variables.mmax] = -999
-                    ind[jind>=self.input.variables.nmax] = -999
-
-                    if z_range:
-                        # Need temporarily create topo indices here to make indices
-                        # only for specific depth ranges
-                        z = get_bathy_on_tile(xm, ym,
-                                              dem_names,
-                                              dem_crs,
-                                              transformer_3857_to_dem,
-                                              dxy,
-                                              bathymetry_database)
-                        ind[z<z_range[0]] = -999
-                        ind[z>z_range[1]] = -999
-
-                    # if self.mask:
-                    if ind.max()>=0:
-                        # Do not include points with mask<1
-                        ingrid      = np.where(ind>=0)
-                        msk         = np.zeros((256,256), dtype=int) + 1
-                        msk[ingrid] = self.grid.ds["mask"].values[jind[ingrid], iind[ingrid]]
-                        iex         = np.where(msk<1)
-                        ind[iex]    = -999
-                    
-                    if np.any(ind>=0):                     
-                        if not path_okay:
-                            if not os.path.exists(zoom_path_i):
-                                fo.mkdir(zoom_path_i)
-                                path_okay = True                             
-                        # And write indices to file
-                        fid = open(file_name, "wb")
-                        fid.write(ind)
-                        fid.close()
+                prefix      = zoom_path_i + os.sep
+
+                for jb in range(0, len(jtiles), nbatch):
+
+                    jj = jtiles[jb:jb + nbatch]
+
+                    # Tile grids on Global Mercator for this batch of tiles
+                    xm = np.repeat(xv[None, :, :] + xo[i - ix0] + 0.5*dxy, len(jj), axis=0)
+                    ym = yv[None, :, :] + yo[jj - iy0][:, None, None] + 0.5*dxy
+
+                    # Convert tile grids to crs of HurryWave model (one call per batch)
+                    if separable:
+                        # Only convert first row and column of each tile and broadcast
+                        x, _ = transformer_b.transform(xm[:, :1, :], ym[:, :1, :])
+                        _, y = transformer_b.transform(xm[:, :, :1], ym[:, :, :1])
+                        x    = np.broadcast_to(x, xm.shape)
+                        y    = np.broadcast_to(y, ym.shape)
+                    else:
+                        x, y = transformer_b.transform(xm, ym)
+
+                    # Rotate around origin of HurryWave model and compute grid indices
+                    # (directly into an int32 buffer, which is the format of the index tiles)
+                    inds = np.empty(x.shape, dtype=np.int32)
+                    _compute_tile_indices(x.ravel(), y.ravel(),
+                                          x0, y0, dx, dy,
+                                          cosrot, sinrot,
+                                          nmax, mmax,
+                                          inds.ravel())
+
+                    for k, j in enumerate(jj):
+
+                        file_name = f"{prefix}{j}.dat"
+
+                        ind = inds[k]
+
+                        if z_range:
+                            # Need temporarily create topo indices here to make indices
+                            # only for specific depth ranges
+                            z = get_bathy_on_tile(xm[k], ym[k],
+                                                  dem_names,
+                                                  dem_crs,
+                                                  transformer_3857_to_dem,
+                                                  dxy,
+                                                  bathymetry_database)
+                            ind[(z<z_range[0]) | (z>z_range[1])] = -999
+
+                        # if self.mask:
+                        valid = ind>=0
+                        if valid.any():
+                            # Do not include points with mask<1
+                            msk        = np.ones((256,256), dtype=np.int8)
+                            msk[valid] = np.take(mask, ind[valid])
+                            iex        = msk<1
+                            ind[iex]   = -999
+                            valid[iex] = False
+
+                        if valid.any():
+                            if not path_okay:
+                                # Create folder once per column, when the first tile is written
+                                os.makedirs(zoom_path_i, exist_ok=True)
+                                path_okay = True
+                            # And write indices to file (always little-endian int32)
+                            ind.astype("<i4", copy=False).tofile(file_name)
 
 
     def setup_wind_uniform_forcing(self, timeseries=None, magnitude=None, direction=None):
@@ -688,12 +765,38 @@ class HurryWave:
 
 
                     
+# Fastmath flags for the Numba kernels. The nnan and ninf flags are left out,
+# so that points that could not be projected (inf/nan) still fail the bounds
+# check in _compute_tile_indices.
+_FASTMATH_NO_NAN_INF = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+@njit(fastmath=_FASTMATH_NO_NAN_INF, cache=True)
+def _rotate(x, y, cosrot, sinrot):
+    # Rotates point (x, y) around the origin
+    return x*cosrot - y*sinrot, x*sinrot + y*cosrot
+
+@njit(parallel=True, fastmath=_FASTMATH_NO_NAN_INF, cache=True)
+def _compute_tile_indices(x, y, x0, y0, dx, dy, cosrot, sinrot, nmax, mmax, out):
+    # Rotates projected tile points around the model origin and writes the
+    # grid index (m*nmax + n) of each point to out, or -999 if it lies outside
+    # the grid. Points that could not be projected (inf/nan) are set to -999 as well.
+    dxinv = 1.0 / dx
+    dyinv = 1.0 / dy
+    for k in prange(x.size):
+        xg, yg = _rotate(x[k] - x0, y[k] - y0, cosrot, sinrot)
+        fi  = np.floor(xg*dxinv)
+        fj  = np.floor(yg*dyinv)
+        if fi >= 0.0 and fj >= 0.0 and fi < mmax and fj < nmax:
+            out[k] = int(fi)*nmax + int(fj)
+        else:
+            out[k] = -999
+
 def read_timeseries_file(file_name, ref_date):
     
     # Returns a dataframe with time series for each of the columns
 
     df = pd.read_csv(file_name, index_col=0, header=None,
-                      delim_whitespace=True)
+                     sep=r"\s+", engine="c")
     ts = ref_date + pd.to_timedelta(df.index, unit="s")
     df.index = ts
     